@@ -5,7 +5,11 @@ import pandas as pd
 import requests
 import sys
 import os
+import atexit
+import threading
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 def get_resource_path(relative_path):
     """获取资源文件的绝对路径，兼容开发环境和打包后的环境"""
@@ -21,20 +25,229 @@ def get_resource_path(relative_path):
 # 全局EasyOCR reader，避免重复初始化
 _ocr_reader = None
 
-def get_ocr_reader():
+def get_ocr_reader(download_enabled=True):
     """获取OCR reader，如果不存在则创建"""
     global _ocr_reader
     if _ocr_reader is None:
         import easyocr
-        _ocr_reader = easyocr.Reader(['ch_sim', 'en'])
+        _ocr_reader = easyocr.Reader(['ch_sim', 'en'], download_enabled=download_enabled)
     return _ocr_reader
 
-def ocr_and_search_prices(ori_img):
+# 奖励界面最多4个物品名称栏位
+MAX_SLOTS = 4
+# 栏位之间的空白列宽度至少为单行文字高度的这个倍数，小于它的空白视为同一名称内的字间距
+SLOT_GAP_RATIO = 1.0
+# 高度小于该值的连通域视为噪点，不参与行高估计和栏位切分
+MIN_CHAR_HEIGHT = 4
+# 文字像素数不到 单字面积(行高的平方)×该值 的列段视为图标、边框等杂物，不算作栏位
+MIN_SLOT_INK = 0.2
+# 裁剪栏位时左右各留的白边
+SLOT_PADDING = 4
+
+def _char_components(mask):
+    """
+    笔画稍作膨胀后每个字基本连成一个连通域
+
+    返回:
+        (去掉噪点后的文字掩码(bool), 保留下来的各连通域高度)
+    """
+    fused = cv2.dilate(mask, np.ones((3, 3), np.uint8))
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(fused)
+    heights = stats[:, cv2.CC_STAT_HEIGHT]
+    keep = heights >= MIN_CHAR_HEIGHT
+    keep[0] = False  # 背景
+    return keep[labels] & (mask > 0), heights[keep]
+
+def _line_height(heights):
+    """估计单行文字的高度：取各字高度的中位数，不受名称换行和零星噪点的影响"""
+    if len(heights) == 0:
+        return MIN_CHAR_HEIGHT
+    return int(np.median(heights))
+
+def split_slots(mask):
+    """
+    按列投影把黄色文字掩码切分为从左到右的名称栏位
+
+    参数:
+        mask: 黄色文字的二值掩码
+        
+    返回:
+        list: 每个栏位的(左, 右)列范围，右边界不包含，最多MAX_SLOTS个
+    """
+    text, heights = _char_components(mask)
+    cols = np.flatnonzero(text.any(axis=0))
+    if len(cols) == 0:
+        return []
+    line_height = _line_height(heights)
+    min_gap = max(int(line_height * SLOT_GAP_RATIO), 2)
+
+    # 相邻文字列之间的空白超过min_gap即为新栏位
+    breaks = np.flatnonzero(np.diff(cols) > min_gap)
+    slots = list(zip(cols[np.concatenate(([0], breaks + 1))].tolist(),
+                     (cols[np.concatenate((breaks, [len(cols) - 1]))] + 1).tolist()))
+
+    # 去掉像素太少的列段，避免杂物占用栏位名额
+    col_ink = text.sum(axis=0)
+    min_ink = MIN_SLOT_INK * line_height ** 2
+    slots = [(left, right) for left, right in slots if col_ink[left:right].sum() >= min_ink]
+
+    # 切分过多时合并最窄的空白，而不是丢弃多出的栏位
+    while len(slots) > MAX_SLOTS:
+        gaps = [slots[i + 1][0] - slots[i][1] for i in range(len(slots) - 1)]
+        i = gaps.index(min(gaps))
+        slots[i:i + 2] = [(slots[i][0], slots[i + 1][1])]
+    return slots
+
+def join_slot_text(result):
+    """把一个栏位内的OCR片段按从上到下、从左到右的阅读顺序拼接成名称"""
+    fragments = []
+    for bbox, text, conf in result:
+        ys = [float(y) for x, y in bbox]
+        xs = [float(x) for x, y in bbox]
+        fragments.append((min(ys), max(ys), min(xs), text))
+    fragments.sort()
+
+    # 中心落在上一行高度范围内的片段归为同一行
+    lines = []
+    for top, bottom, left, text in fragments:
+        center = (top + bottom) / 2
+        if lines and lines[-1]['top'] <= center <= lines[-1]['bottom']:
+            lines[-1]['parts'].append((left, text))
+        else:
+            lines.append({'top': top, 'bottom': bottom, 'parts': [(left, text)]})
+    return ''.join(text for line in lines for left, text in sorted(line['parts']))
+
+def _init_slot_worker(threads):
+    """进程池初始化：固定torch线程数并预先创建reader，模型已由主进程下载"""
+    import torch
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(1)
+    get_ocr_reader(download_enabled=False)
+
+def _readtext_in_worker(image, kwargs):
+    """在工作进程中识别一个栏位，结果转为可序列化的普通类型"""
+    result = get_ocr_reader().readtext(image, **kwargs)
+    return [([[float(x), float(y)] for x, y in bbox], text, float(conf))
+            for bbox, text, conf in result]
+
+def _worker_ready(_):
+    return os.getpid()
+
+class SlotRecognizer:
+    """
+    多进程栏位识别器，每个工作进程持有一个已预热的EasyOCR reader
+
+    CPU上torch处理小图时很难用满所有核心，因此各栏位分别交给独立的进程并行识别，
+    每个进程的线程数固定为 核心数/进程数，避免线程之间互相争抢。
+    主进程也持有一个reader：启动进程池前由它下载模型，避免多个进程同时下载，
+    进程池崩溃时也由它接手识别。
+    有CUDA时不启用进程池，直接在主进程用GPU识别，避免每个进程各占一份显存。
+    """
+
+    def __init__(self, workers=None, threads=None):
+        import torch
+        cpus = os.cpu_count() or 1
+        if torch.cuda.is_available():
+            workers = 1
+        self.workers = workers or max(1, min(MAX_SLOTS, cpus))
+        self.threads = threads or max(1, cpus // self.workers)
+        get_ocr_reader()
+        self._pool = self._create_pool()
+
+    def _create_pool(self):
+        if self.workers <= 1:
+            return None
+        return ProcessPoolExecutor(max_workers=self.workers,
+                                   initializer=_init_slot_worker,
+                                   initargs=(self.threads,))
+
+    def warm_up(self):
+        """启动全部工作进程并创建reader，减少首次识别的延迟"""
+        if self._pool is None:
+            return
+        list(self._pool.map(_worker_ready, range(self.workers)))
+
+    def readtext(self, image, **kwargs):
+        return self.readtext_batch([image], **kwargs)[0]
+
+    def readtext_batch(self, images, **kwargs):
+        """并行识别多张栏位图，结果顺序与输入一致"""
+        if self._pool is not None:
+            try:
+                futures = [self._pool.submit(_readtext_in_worker, image, kwargs) for image in images]
+                return [f.result() for f in futures]
+            except BrokenProcessPool as e:
+                # 工作进程异常退出（如内存不足），重建进程池，本次改在主进程识别
+                print(f"识别进程异常退出，重建进程池: {e}")
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = self._create_pool()
+        reader = get_ocr_reader()
+        return [reader.readtext(image, **kwargs) for image in images]
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+# 全局栏位识别器
+_slot_recognizer = None
+# 预热线程与F8热键线程可能同时创建识别器，加锁避免重复启动进程池
+_slot_recognizer_lock = threading.Lock()
+
+def get_slot_recognizer():
+    """获取多进程栏位识别器，如果不存在则创建"""
+    global _slot_recognizer
+    with _slot_recognizer_lock:
+        if _slot_recognizer is None:
+            _slot_recognizer = SlotRecognizer()
+            atexit.register(_slot_recognizer.shutdown)
+    return _slot_recognizer
+
+def extract_yellow_text(img):
+    """
+    提取黄色文字
+
+    返回:
+        (黄色文字掩码, 白底黄字图)
+    """
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    lower_yellow = np.array([20, 100, 150])
+    upper_yellow = np.array([26, 255, 255])
+    mask = cv2.inRange(hsv, lower_yellow, upper_yellow)
+
+    # 白底
+    white_bg = np.ones_like(img) * 255
+    result = cv2.bitwise_and(img, img, mask=mask)
+    inv_mask = cv2.bitwise_not(mask)
+    white_part = cv2.bitwise_and(white_bg, white_bg, mask=inv_mask)
+    final = cv2.add(result, white_part)
+    return mask, final
+
+def crop_slots(mask, final):
+    """
+    按栏位裁剪
+
+    返回:
+        (各栏位的白底黄字图, 各栏位的文字掩码)，从左到右排列
+    """
+    slot_images = []
+    slot_masks = []
+    for left, right in split_slots(mask):
+        left = max(left - SLOT_PADDING, 0)
+        right = min(right + SLOT_PADDING, final.shape[1])
+        slot_images.append(np.ascontiguousarray(final[:, left:right]))
+        slot_masks.append(mask[:, left:right])
+    return slot_images, slot_masks
+
+def ocr_and_search_prices(ori_img, reader=None, http_get=None, template_bank=None):
     """
     OCR识别图片中的物品并查询Warframe Market价格
     
     参数:
         ori_img: 输入图片路径或numpy数组
+        reader: 可选，提供readtext方法的OCR reader，默认使用全局多进程栏位识别器
+        http_get: 可选，替代requests.get的HTTP请求函数，用于录制/回放轨迹
+        template_bank: 可选，模板特征库，提供时先做模板匹配，置信度低的栏位再交给OCR
         
     返回:
         list: 包含所有识别和搜索结果的列表
@@ -47,17 +260,7 @@ def ocr_and_search_prices(ori_img):
     else:
         img = ori_img
         
-    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-    lower_yellow = np.array([20, 100, 150])
-    upper_yellow = np.array([26, 255, 255])
-    mask = cv2.inRange(hsv, lower_yellow, upper_yellow)
-
-    # 白底
-    white_bg = np.ones_like(img) * 255
-    result = cv2.bitwise_and(img, img, mask=mask)
-    inv_mask = cv2.bitwise_not(mask)
-    white_part = cv2.bitwise_and(white_bg, white_bg, mask=inv_mask)
-    final = cv2.add(result, white_part)
+    mask, final = extract_yellow_text(img)
     cv2.imwrite('yellow_on_white_ori.png', final)
 
     # ---- 步骤2：自动裁剪文字区域 ----
@@ -81,49 +284,36 @@ def ocr_and_search_prices(ori_img):
     # cropped = img[top:bottom+1, left:right+1]
     # cv2.imwrite('cropped.png', cropped)
 
-    # ---- 步骤3：EasyOCR识别文字，进行包含合并 ----
-    reader = get_ocr_reader()  # 使用全局reader，避免重复初始化
-    
-    # 直接从处理后的图像进行OCR，避免文件读写
-    if isinstance(ori_img, str):
-        result = reader.readtext(ori_img, detail=1)
+    # ---- 步骤3：按栏位切分，模板匹配后EasyOCR并行识别剩余栏位 ----
+    if reader is None:
+        reader = get_slot_recognizer()  # 使用全局识别器，避免重复初始化
+    if http_get is None:
+        http_get = requests.get
+
+    slot_images, slot_masks = crop_slots(mask, final)
+
+    # 模板匹配成功的栏位不再需要OCR
+    slot_texts = [None] * len(slot_images)
+    slot_confs = [None] * len(slot_images)
+    if template_bank is not None:
+        for i, slot_mask in enumerate(slot_masks):
+            slot_texts[i], _ = template_bank.match(slot_mask)
+
+    pending = [i for i, text in enumerate(slot_texts) if text is None]
+    pending_images = [slot_images[i] for i in pending]
+    if hasattr(reader, 'readtext_batch'):
+        slot_results = reader.readtext_batch(pending_images, detail=1)
     else:
-        # 如果是numpy数组，直接使用
-        result = reader.readtext(final, detail=1)
-
-    # 3. 画bbox到图片上
-    # for bbox, text, conf in result:
-    #     # 将裁剪后的坐标转换为原始图片坐标
-    #     pts = [(int(float(x) + int(left)), int(float(y) + int(top))) for x, y in bbox]
-    #     # 画多边形框线，pts顺序通常是左上-右上-右下-左下
-    #     cv2.polylines(img, [np.array(pts)], isClosed=True, color=(0,255,0), thickness=2)
-
-    # # 4. 保存结果图片
-    # cv2.imwrite('ocr_boxed.png', img)
-    #results.append('已保存带框图片 ocr_boxed.png')
-    
-    # 转结构化list
+        slot_results = [reader.readtext(image, detail=1) for image in pending_images]
+    for i, result in zip(pending, slot_results):
+        slot_texts[i] = join_slot_text(result)
+        slot_confs[i] = min((conf for bbox, text, conf in result), default=0.0)
+
+    # 每个栏位拼接为一个名称，栏位本身已按从左到右排列
     items = []
-    for bbox, text, conf in result:
-        x1 = int(bbox[0][0])
-        x2 = int(bbox[2][0])
-        if x1 > x2:
-            x1, x2 = x2, x1
-        items.append({'x1': x1, 'x2': x2, 'text': text, 'merged': False})
-
-    # 包含合并逻辑
-    # 记录被合并掉的元素的下标
-    merged_indices = []
-    for i, item_a in enumerate(items):
-        for j in range(i + 1, len(items)):
-            item_b = items[j]
-            if item_a['x1'] <= item_b['x1'] and item_a['x2'] >= item_b['x2']:
-                item_b['text'] = item_a['text'] + item_b['text']
-                merged_indices.append(i)  # 不去重，每次合并都记一次
-
-    # 按下标逆序删除，避免下标错位
-    for idx in sorted(set(merged_indices), reverse=True):
-        del items[idx]
+    for i, text in enumerate(slot_texts):
+        if text:
+            items.append({'text': text, 'mask': slot_masks[i], 'conf': slot_confs[i]})
 
     # 输出最终结果
     #results.append("最终合并结果：")
@@ -135,6 +325,8 @@ def ocr_and_search_prices(ori_img):
     df_map = pd.read_csv(csv_path)
     df_map['Chinese_nospace'] = df_map['Chinese'].str.replace(' ', '')
     cn2url = dict(zip(df_map['Chinese_nospace'], df_map['url_name']))
+    # 模板以词库中的原名（去空格）为标签，与渲染模板保持一致
+    cn_lower2cn = {k.lower(): k for k in cn2url}
 
     def find_en_by_cn(cn):
         # 查找前先去空格，并转换为小写
@@ -149,7 +341,7 @@ def ocr_and_search_prices(ori_img):
         headers = {
             'accept': 'application/json'
         }
-        r = requests.get(url, headers=headers)
+        r = http_get(url, headers=headers)
         if r.status_code != 200:
             return None
         data = r.json()
@@ -181,6 +373,10 @@ def ocr_and_search_prices(ori_img):
         
         en = find_en_by_cn(search_zh)
         if en:
+            # OCR结果精确匹配到词库，作为候选模板交给特征库审核
+            if template_bank is not None and item['conf'] is not None:
+                canonical = cn_lower2cn[search_zh.replace(' ', '').lower()]
+                template_bank.harvest(item['mask'], canonical, item['conf'])
             # ---- 精确匹配查价 ----
             price_counter = get_wfm_prices(en)
             if price_counter:
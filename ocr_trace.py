@@ -0,0 +1,377 @@
+"""
+F8识别轨迹的录制与回放
+
+录制：每次按F8时把裁剪后的截图、reader.readtext的原始输出、
+get_wfm_prices的每一次HTTP响应连同时间戳写入一个zip轨迹文件。
+开启模板匹配时同时记录每个栏位的匹配结果。
+回放：离线、全速地从轨迹重新跑一遍识别流程，任意阶段都可以换成实时执行，
+用于性能分析和用真实数据做回归测试。
+
+用法:
+    python ocr_trace.py traces/xxx.zip [更多轨迹...] [--live-ocr] [--live-http] [--live-template] [--profile]
+"""
+import cv2
+import numpy as np
+import requests
+import argparse
+import json
+import time
+import zipfile
+import os
+import sys
+from ocr import ocr_and_search_prices, get_slot_recognizer
+from template_match import get_template_bank
+
+# 2: ocr_calls按栏位逐个记录
+TRACE_VERSION = 2
+
+
+def _format_error(e):
+    return f"{type(e).__name__}: {e}"
+
+
+class TraceResponse:
+    """录制/回放用的HTTP响应，只提供get_wfm_prices用到的接口"""
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+
+    def json(self):
+        if self._body is None:
+            raise ValueError("响应不是JSON")
+        return self._body
+
+
+class _RecordingReader:
+    """包装OCR reader，记录每次readtext的原始输出"""
+
+    def __init__(self, reader, recorder):
+        self._reader = reader
+        self._recorder = recorder
+
+    def _record(self, result, **timing):
+        self._recorder.ocr_calls.append(dict(timing, result=[
+            [[[float(x), float(y)] for x, y in bbox], text, float(conf)]
+            for bbox, text, conf in result
+        ]))
+
+    def readtext(self, image, **kwargs):
+        start = self._recorder.elapsed()
+        result = self._reader.readtext(image, **kwargs)
+        self._record(result, t=start, duration=self._recorder.elapsed() - start)
+        return result
+
+    def readtext_batch(self, images, **kwargs):
+        """
+        保留被包装reader的并行识别，按栏位顺序逐个记录输出
+
+        并行识别拿不到单个栏位的耗时，因此计时记在ocr_batches中，
+        各栏位的记录只标明所属批次。
+        """
+        if not hasattr(self._reader, 'readtext_batch'):
+            return [self.readtext(image, **kwargs) for image in images]
+        start = self._recorder.elapsed()
+        results = self._reader.readtext_batch(images, **kwargs)
+        batch = len(self._recorder.ocr_batches)
+        self._recorder.ocr_batches.append({
+            't': start,
+            'duration': self._recorder.elapsed() - start,
+            'size': len(images),
+        })
+        for result in results:
+            self._record(result, batch=batch)
+        return results
+
+
+class _RecordingBank:
+    """包装模板特征库，记录每个栏位的匹配结果"""
+
+    def __init__(self, bank, recorder):
+        self._bank = bank
+        self._recorder = recorder
+
+    def match(self, mask):
+        start = self._recorder.elapsed()
+        name, score = self._bank.match(mask)
+        self._recorder.template_calls.append({
+            't': start,
+            'duration': self._recorder.elapsed() - start,
+            'name': name,
+            'score': score,
+        })
+        return name, score
+
+    def harvest(self, mask, name, conf):
+        return self._bank.harvest(mask, name, conf)
+
+
+class TraceRecorder:
+    """录制一次F8识别的全部输入"""
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+        self.ocr_calls = []
+        self.ocr_batches = []
+        self.http_calls = []
+        self.template_calls = None
+        self.results = None
+        self.error = None
+        self.duration = None
+
+    def elapsed(self):
+        """距离开始录制经过的秒数"""
+        return time.perf_counter() - self._t0
+
+    def wrap_reader(self, reader):
+        return _RecordingReader(reader, self)
+
+    def http_get(self, url, **kwargs):
+        """替代requests.get，记录状态码和JSON响应，请求失败时记录异常以便回放重现"""
+        start = self.elapsed()
+        try:
+            r = requests.get(url, **kwargs)
+        except requests.RequestException as e:
+            self.http_calls.append({
+                't': start,
+                'duration': self.elapsed() - start,
+                'url': url,
+                'error_type': type(e).__name__,
+                'error': str(e),
+            })
+            raise
+        try:
+            body = r.json()
+        except ValueError:
+            body = None
+        self.http_calls.append({
+            't': start,
+            'duration': self.elapsed() - start,
+            'url': url,
+            'status_code': r.status_code,
+            'json': body,
+        })
+        # 返回已解析的响应，避免调用方再解析一次
+        return TraceResponse(r.status_code, body)
+
+    def run(self, reader=None, template_bank=None):
+        """执行识别流程并录制，返回识别结果；出错时记录异常后继续抛出"""
+        if reader is None:
+            reader = get_slot_recognizer()
+        if template_bank is not None:
+            self.template_calls = []
+            template_bank = _RecordingBank(template_bank, self)
+        try:
+            self.results = ocr_and_search_prices(self.frame, reader=self.wrap_reader(reader),
+                                                 http_get=self.http_get,
+                                                 template_bank=template_bank)
+        except Exception as e:
+            self.error = _format_error(e)
+            raise
+        finally:
+            self.duration = self.elapsed()
+        return self.results
+
+    def save(self, path):
+        """保存为zip轨迹文件：frame.png + trace.json"""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        ok, png = cv2.imencode('.png', self.frame)
+        if not ok:
+            raise ValueError("截图编码失败")
+        meta = {
+            'version': TRACE_VERSION,
+            'started_at': self.started_at,
+            'duration': self.duration,
+            'ocr_calls': self.ocr_calls,
+            'ocr_batches': self.ocr_batches,
+            'http_calls': self.http_calls,
+            'template_calls': self.template_calls,
+            'results': self.results,
+            'error': self.error,
+        }
+        with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('frame.png', png.tobytes())
+            zf.writestr('trace.json', json.dumps(meta, ensure_ascii=False))
+        return path
+
+
+def record_press(frame, trace_dir='traces', reader=None, template_bank=None):
+    """
+    识别一帧截图并把轨迹保存到trace_dir，返回识别结果
+
+    识别出错时同样保存轨迹（记录异常信息）后再抛出，便于重现；
+    保存轨迹失败不影响识别结果。
+    """
+    recorder = TraceRecorder(frame)
+    try:
+        return recorder.run(reader, template_bank)
+    finally:
+        name = time.strftime('%Y%m%d_%H%M%S', time.localtime(recorder.started_at))
+        name += f'_{int(recorder.started_at * 1000) % 1000:03d}.zip'
+        try:
+            recorder.save(os.path.join(trace_dir, name))
+        except Exception as e:
+            print(f"保存识别轨迹失败: {e}")
+
+
+def load_trace(path):
+    """读取轨迹文件，返回(截图, 元数据)"""
+    with zipfile.ZipFile(path) as zf:
+        png = np.frombuffer(zf.read('frame.png'), dtype=np.uint8)
+        meta = json.loads(zf.read('trace.json').decode('utf-8'))
+    if meta.get('version') != TRACE_VERSION:
+        raise ValueError(f"不支持的轨迹版本: {meta.get('version')}")
+    frame = cv2.imdecode(png, cv2.IMREAD_COLOR)
+    return frame, meta
+
+
+class ReplayReader:
+    """按录制顺序返回readtext的原始输出"""
+
+    def __init__(self, ocr_calls):
+        self._calls = list(ocr_calls)
+
+    def readtext(self, image, **kwargs):
+        if not self._calls:
+            raise LookupError("轨迹中没有更多的OCR输出")
+        call = self._calls.pop(0)
+        return [(bbox, text, conf) for bbox, text, conf in call['result']]
+
+
+class ReplayHttp:
+    """按URL返回录制的HTTP响应，同一URL多次请求按录制顺序返回，录制时失败的请求抛出同类异常"""
+
+    def __init__(self, http_calls):
+        self._responses = {}
+        for call in http_calls:
+            self._responses.setdefault(call['url'], []).append(call)
+
+    def get(self, url, **kwargs):
+        calls = self._responses.get(url)
+        if not calls:
+            raise LookupError(f"轨迹中没有该请求的响应: {url}")
+        call = calls.pop(0) if len(calls) > 1 else calls[0]
+        if 'error' in call:
+            error_type = getattr(requests.exceptions, call['error_type'], requests.RequestException)
+            raise error_type(call['error'])
+        return TraceResponse(call['status_code'], call['json'])
+
+
+class ReplayBank:
+    """按录制顺序返回模板匹配结果，回放时不收集模板"""
+
+    def __init__(self, template_calls):
+        self._calls = list(template_calls)
+
+    def match(self, mask):
+        if not self._calls:
+            raise LookupError("轨迹中没有更多的模板匹配结果")
+        call = self._calls.pop(0)
+        return call['name'], call['score']
+
+    def harvest(self, mask, name, conf):
+        return False
+
+
+class _ReadOnlyBank:
+    """使用本地特征库匹配但不收集模板，回放不会改动特征库"""
+
+    def __init__(self, bank):
+        self._bank = bank
+
+    def match(self, mask):
+        return self._bank.match(mask)
+
+    def harvest(self, mask, name, conf):
+        return False
+
+
+def replay_trace(path, live_ocr=False, live_http=False, live_template=False):
+    """
+    从轨迹重新执行识别流程
+
+    参数:
+        path: 轨迹文件路径
+        live_ocr: 为True时使用实时EasyOCR代替录制的OCR输出
+        live_http: 为True时实时请求Warframe Market代替录制的响应
+        live_template: 为True时使用本地特征库代替录制的模板匹配结果，
+            需同时使用实时OCR，因为模板匹配的结果决定了哪些栏位需要OCR
+
+    返回:
+        (识别结果, 轨迹元数据)
+    """
+    if live_template and not live_ocr:
+        raise ValueError("使用本地特征库回放时必须同时使用实时OCR")
+    frame, meta = load_trace(path)
+    reader = get_slot_recognizer() if live_ocr else ReplayReader(meta['ocr_calls'])
+    http_get = requests.get if live_http else ReplayHttp(meta['http_calls']).get
+    template_bank = None
+    if live_template:
+        template_bank = _ReadOnlyBank(get_template_bank())
+    elif meta.get('template_calls') is not None:
+        template_bank = ReplayBank(meta['template_calls'])
+    results = ocr_and_search_prices(frame, reader=reader, http_get=http_get,
+                                    template_bank=template_bank)
+    return results, meta
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='回放F8识别轨迹')
+    parser.add_argument('traces', nargs='+', help='轨迹文件(.zip)')
+    parser.add_argument('--live-ocr', action='store_true', help='使用实时OCR')
+    parser.add_argument('--live-http', action='store_true', help='使用实时网络请求')
+    parser.add_argument('--live-template', action='store_true', help='使用本地模板特征库（需同时指定--live-ocr）')
+    parser.add_argument('--profile', action='store_true', help='用cProfile分析回放过程')
+    args = parser.parse_args(argv)
+    if args.live_template and not args.live_ocr:
+        parser.error("--live-template 需要同时指定 --live-ocr")
+
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    mismatched = 0
+    for path in args.traces:
+        start = time.perf_counter()
+        error = None
+        try:
+            results, meta = replay_trace(path, live_ocr=args.live_ocr, live_http=args.live_http,
+                                         live_template=args.live_template)
+        except Exception as e:
+            # 录制时出错的轨迹，回放应当重现同样的异常
+            error = _format_error(e)
+            results = []
+            _, meta = load_trace(path)
+        elapsed = time.perf_counter() - start
+        recorded = meta.get('results')
+        recorded_error = meta.get('error')
+        same = error == recorded_error and (recorded is None or results == recorded)
+        if not same:
+            mismatched += 1
+        print(f"{path}: 回放 {elapsed * 1000:.1f}ms，录制时 {(meta.get('duration') or 0) * 1000:.1f}ms，"
+              f"{'结果一致' if same else '结果不一致'}")
+        for result in results:
+            print(f"  {result}")
+        if error:
+            print(f"  出错: {error}")
+        if not same:
+            print("  录制结果:")
+            for result in recorded or []:
+                print(f"  {result}")
+            if recorded_error:
+                print(f"  出错: {recorded_error}")
+
+    if profiler is not None:
+        import pstats
+        profiler.disable()
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+
+    return 1 if mismatched else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,384 @@
+"""
+基于模板匹配的物品名称识别
+
+奖励界面的名称总是同一种字体和颜色，因此可以把每个栏位的黄色文字掩码
+缩放成固定大小的特征向量，与特征库做向量化的归一化互相关(NCC)，
+几毫秒内就能在CPU上认出名称，只有置信度低时才交给EasyOCR。
+
+特征库的来源：
+1. 用字体渲染wfm_item_names_en_zh.csv中的所有中文名称（需要提供接近游戏的字体，
+   只渲染单行，游戏中换成两行的长名称仍需靠第2种方式收集）
+2. 运行中收集EasyOCR高置信度识别、且精确匹配到词库的栏位
+
+用法:
+    python template_match.py render --font 字体文件.ttf [--size 28]
+    python template_match.py calibrate traces/*.zip
+    python template_match.py remove 名称
+以上命令都可以加 --bank 指定特征库文件，默认 template_bank.npz
+"""
+import cv2
+import numpy as np
+import pandas as pd
+import argparse
+import atexit
+import os
+import sys
+import threading
+
+# 特征图大小(宽, 高)
+FEATURE_SIZE = (64, 24)
+FEATURE_DIM = FEATURE_SIZE[0] * FEATURE_SIZE[1]
+# 最佳模板的相关系数达到该值才认为匹配成功
+MATCH_THRESHOLD = 0.92
+# 最佳模板还需比其他名称的最佳模板高出该值，
+# 否则视为无法区分（如同一Prime物品的各个部件只有最后几个字不同）
+MATCH_MARGIN = 0.04
+# 以上两个值是初始值，应当用 calibrate 命令在录制的轨迹上核对后再调整
+# 宽高比差异超过该值(取对数)的模板直接跳过
+ASPECT_TOLERANCE = 0.25
+# 收集模板时要求OCR每个片段的置信度都不低于该值
+HARVEST_MIN_CONF = 0.8
+# 核对阈值时，相关系数高于该值的模板视为样本自身被收集进来的模板
+SELF_MATCH_SCORE = 0.999
+
+
+def slot_feature(mask):
+    """
+    把一个栏位的文字掩码转为特征向量
+
+    参数:
+        mask: 栏位的黄色文字二值掩码
+
+    返回:
+        (特征向量, 宽高比)，掩码为空时返回(None, None)
+    """
+    ys, xs = np.nonzero(mask)
+    if len(xs) == 0:
+        return None, None
+    crop = mask[ys.min():ys.max() + 1, xs.min():xs.max() + 1]
+    aspect = crop.shape[1] / crop.shape[0]
+    feature = cv2.resize(crop, FEATURE_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32).ravel()
+    feature -= feature.mean()
+    norm = np.linalg.norm(feature)
+    if norm == 0:
+        return None, None
+    return feature / norm, aspect
+
+
+class TemplateBank:
+    """
+    名称特征库，保存为npz文件
+
+    特征按容量成倍扩展的缓冲区存放，收集模板时不必每次复制整个矩阵；
+    修改只在flush时写盘，不阻塞F8识别。
+    """
+
+    def __init__(self, path=None, threshold=MATCH_THRESHOLD, margin=MATCH_MARGIN):
+        self.path = path
+        self.threshold = threshold
+        self.margin = margin
+        self.dirty = False
+        self._size = 0
+        self._names = np.zeros(0, dtype='U64')
+        self._features = np.zeros((0, FEATURE_DIM), dtype=np.float32)
+        self._log_aspects = np.zeros(0, dtype=np.float32)
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def names(self):
+        return self._names[:self._size]
+
+    @property
+    def features(self):
+        return self._features[:self._size]
+
+    @property
+    def log_aspects(self):
+        return self._log_aspects[:self._size]
+
+    def load(self):
+        with np.load(self.path) as data:
+            self._names = data['names'].astype('U64')
+            self._features = data['features'].astype(np.float32)
+            self._log_aspects = data['log_aspects'].astype(np.float32)
+        self._size = len(self._names)
+        self.dirty = False
+
+    def save(self):
+        """以float16保存特征，减小文件体积；先写临时文件再替换，写到一半中断不会损坏原文件"""
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, names=self.names,
+                     features=self.features.astype(np.float16),
+                     log_aspects=self.log_aspects)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def flush(self):
+        """有未保存的修改时写盘"""
+        if self.dirty:
+            self.save()
+
+    def _scores(self, feature, aspect):
+        scores = self.features @ feature
+        scores[np.abs(self.log_aspects - np.log(aspect)) > ASPECT_TOLERANCE] = -1.0
+        return scores
+
+    def _decide(self, scores, threshold, margin):
+        """按阈值和领先幅度判定，返回(名称, 相关系数)，无法确定时名称为None"""
+        best = int(np.argmax(scores))
+        name = str(self.names[best])
+        score = float(scores[best])
+        if score < threshold:
+            return None, score
+        others = scores[self.names != name]
+        if len(others) and score - float(others.max()) < margin:
+            return None, score
+        return name, score
+
+    def match(self, mask):
+        """
+        匹配一个栏位
+
+        返回:
+            (名称, 相关系数)，低于阈值或与其他名称拉不开差距时名称为None
+        """
+        if len(self) == 0:
+            return None, 0.0
+        feature, aspect = slot_feature(mask)
+        if feature is None:
+            return None, 0.0
+        return self._decide(self._scores(feature, aspect), self.threshold, self.margin)
+
+    def harvest(self, mask, name, conf):
+        """
+        收集一个OCR识别并精确匹配到词库的栏位
+
+        以下情况不收集：OCR置信度不够；特征库已能用match认出该名称；
+        其他名称的模板比同名模板更相似，或者没有同名模板而特征库能确定地认作其他名称
+        （多半是OCR把相近的名称认错了，收集会污染特征库）。
+        只是领先幅度不够而交给OCR的栏位会被收集，用游戏中的实际字形把相近的名称区分开。
+        误收集的模板可以用 remove 命令删除。
+
+        返回:
+            bool: 是否添加了新模板
+        """
+        if conf < HARVEST_MIN_CONF:
+            return False
+        feature, aspect = slot_feature(mask)
+        if feature is None:
+            return False
+        if len(self):
+            scores = self._scores(feature, aspect)
+            matched, _ = self._decide(scores, self.threshold, self.margin)
+            if matched == name:
+                return False
+            same_name = self.names == name
+            if same_name.any():
+                if (~same_name).any() and scores[~same_name].max() > scores[same_name].max():
+                    return False
+            elif matched is not None:
+                return False
+        self._append([name], [feature], [np.log(aspect)])
+        return True
+
+    def remove(self, name):
+        """删除某个名称的全部模板，返回删除数量"""
+        keep = self.names != name
+        removed = int(len(self) - keep.sum())
+        if removed:
+            self._names = self.names[keep]
+            self._features = self.features[keep]
+            self._log_aspects = self.log_aspects[keep]
+            self._size = len(self._names)
+            self.dirty = True
+        return removed
+
+    def _append(self, names, features, log_aspects):
+        size = self._size + len(names)
+        if size > len(self._names):
+            capacity = max(size, len(self._names) * 2, 64)
+            self._names = np.resize(self._names, capacity)
+            features_buffer = np.zeros((capacity, FEATURE_DIM), dtype=np.float32)
+            features_buffer[:self._size] = self.features
+            self._features = features_buffer
+            self._log_aspects = np.resize(self._log_aspects, capacity)
+        self._names[self._size:size] = names
+        self._features[self._size:size] = features
+        self._log_aspects[self._size:size] = log_aspects
+        self._size = size
+        self.dirty = True
+
+
+def render_name_mask(text, font, padding=4):
+    """用字体把一个名称渲染为单行，返回文字掩码"""
+    from PIL import Image, ImageDraw
+    left, top, right, bottom = font.getbbox(text)
+    image = Image.new('L', (right - left + padding * 2, bottom - top + padding * 2), 0)
+    ImageDraw.Draw(image).text((padding - left, padding - top), text, fill=255, font=font)
+    return (np.array(image) > 127).astype(np.uint8) * 255
+
+
+def render_catalog(bank, font_path, csv_path, font_size=28):
+    """
+    渲染词库中的全部中文名称加入特征库，返回新增数量
+
+    按游戏中的写法带空格渲染（如"迅发电浆炮 Prime 枪管"），标签去掉空格。
+    只渲染单行，游戏中换行显示的长名称匹配不上时会交给OCR，再由收集补充。
+    """
+    from PIL import ImageFont
+    font = ImageFont.truetype(font_path, font_size)
+    df_map = pd.read_csv(csv_path)
+    existing = set(bank.names.tolist())
+    names, features, log_aspects = [], [], []
+    for text in df_map['Chinese'].dropna().unique():
+        name = text.replace(' ', '')
+        if name in existing:
+            continue
+        feature, aspect = slot_feature(render_name_mask(text, font))
+        if feature is None:
+            continue
+        existing.add(name)
+        names.append(name)
+        features.append(feature)
+        log_aspects.append(np.log(aspect))
+    # 一次性追加，避免逐个添加
+    if names:
+        bank._append(names, features, log_aspects)
+    bank.save()
+    return len(names)
+
+
+def calibrate(bank, trace_paths, csv_path):
+    """
+    用录制的轨迹核对匹配阈值
+
+    以轨迹中OCR高置信度、且精确匹配到词库的栏位为标准答案，
+    统计不同阈值和领先幅度下模板匹配的正确、错误和交给OCR的栏位数。
+    录制时这些栏位多半已被收集进特征库，与自身模板比较会得到接近1的相关系数，
+    因此相关系数高于SELF_MATCH_SCORE的模板不参与该样本的统计。
+
+    返回:
+        list: (阈值, 领先幅度, 正确数, 错误数, 交给OCR数)
+    """
+    from ocr import extract_yellow_text, crop_slots, join_slot_text
+    from ocr_trace import load_trace
+
+    df_map = pd.read_csv(csv_path)
+    catalog = {name.lower(): name for name in df_map['Chinese'].dropna().str.replace(' ', '')}
+
+    samples = []
+    for path in trace_paths:
+        frame, meta = load_trace(path)
+        mask, final = extract_yellow_text(frame)
+        _, slot_masks = crop_slots(mask, final)
+        template_calls = meta.get('template_calls')
+        if template_calls is None:
+            pending = list(range(len(slot_masks)))
+        else:
+            pending = [i for i, call in enumerate(template_calls) if call['name'] is None]
+        # 栏位切分方式变过的旧轨迹对不上，跳过
+        if len(pending) != len(meta['ocr_calls']) or (
+                template_calls is not None and len(template_calls) != len(slot_masks)):
+            print(f"{path}: 栏位数与录制时不一致，跳过")
+            continue
+        for i, call in zip(pending, meta['ocr_calls']):
+            result = call['result']
+            if not result or min(conf for bbox, text, conf in result) < HARVEST_MIN_CONF:
+                continue
+            text = join_slot_text(result).replace(' ', '')
+            if text.endswith('蓝'):
+                text += '图'
+            name = catalog.get(text.lower())
+            feature, aspect = slot_feature(slot_masks[i])
+            if name is None or feature is None:
+                continue
+            scores = bank._scores(feature, aspect)
+            scores[scores > SELF_MATCH_SCORE] = -1.0
+            samples.append((name, scores))
+
+    print(f"有效样本 {len(samples)} 个")
+    table = []
+    for threshold in (0.86, 0.88, 0.90, 0.92, 0.94, 0.96):
+        for margin in (0.0, 0.02, 0.04, 0.06, 0.08):
+            correct = wrong = fallback = 0
+            for name, scores in samples:
+                matched, _ = bank._decide(scores, threshold, margin)
+                if matched is None:
+                    fallback += 1
+                elif matched == name:
+                    correct += 1
+                else:
+                    wrong += 1
+            table.append((threshold, margin, correct, wrong, fallback))
+    return table
+
+
+# 全局特征库，避免重复加载
+_template_bank = None
+_template_bank_lock = threading.Lock()
+
+def get_template_bank():
+    """获取特征库，如果不存在则从磁盘加载，文件损坏时从空特征库开始；退出时保存收集到的模板"""
+    global _template_bank
+    with _template_bank_lock:
+        if _template_bank is None:
+            path = 'template_bank.npz'
+            try:
+                _template_bank = TemplateBank(path)
+            except Exception as e:
+                print(f"加载模板特征库失败，使用空特征库: {e}")
+                _template_bank = TemplateBank()
+                _template_bank.path = path
+            atexit.register(flush_template_bank)
+    return _template_bank
+
+def flush_template_bank():
+    """保存已加载的特征库，未加载过时什么都不做；保存失败只打印错误"""
+    if _template_bank is None:
+        return
+    try:
+        _template_bank.flush()
+    except Exception as e:
+        print(f"保存模板特征库失败: {e}")
+
+
+def main(argv=None):
+    from ocr import get_resource_path
+    parser = argparse.ArgumentParser(description='模板特征库工具')
+    parser.add_argument('--bank', default='template_bank.npz', help='特征库文件')
+    commands = parser.add_subparsers(dest='command', required=True)
+    render = commands.add_parser('render', help='用字体渲染词库名称加入特征库')
+    render.add_argument('--font', required=True, help='与游戏接近的中文字体文件')
+    render.add_argument('--size', type=int, default=28, help='渲染字号')
+    calib = commands.add_parser('calibrate', help='用录制的轨迹核对匹配阈值')
+    calib.add_argument('traces', nargs='+', help='轨迹文件(.zip)')
+    remove = commands.add_parser('remove', help='删除某个名称的全部模板')
+    remove.add_argument('name', help='名称（去掉空格）')
+    args = parser.parse_args(argv)
+
+    bank = TemplateBank(args.bank)
+    csv_path = get_resource_path('wfm_item_names_en_zh.csv')
+    if args.command == 'render':
+        added = render_catalog(bank, args.font, csv_path, args.size)
+        print(f"新增 {added} 个模板，特征库共 {len(bank)} 个模板")
+    elif args.command == 'calibrate':
+        print(f"当前阈值 {bank.threshold}，领先幅度 {bank.margin}")
+        print("阈值  领先幅度  正确  错误  交给OCR")
+        for threshold, margin, correct, wrong, fallback in calibrate(bank, args.traces, csv_path):
+            print(f"{threshold:.2f}  {margin:.2f}      {correct:<4}  {wrong:<4}  {fallback}")
+    else:
+        removed = bank.remove(args.name)
+        bank.flush()
+        print(f"删除 {removed} 个模板，特征库共 {len(bank)} 个模板")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
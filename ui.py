@@ -10,7 +10,10 @@ import sys
 import keyboard
 import pyperclip
 import threading
+import multiprocessing
 from ocr import ocr_and_search_prices
+from ocr_trace import record_press
+from template_match import get_template_bank, flush_template_bank
 
 def get_resource_path(relative_path):
     """获取资源文件的绝对路径，兼容开发环境和打包后的环境"""
@@ -59,7 +62,10 @@ class WFOCRApp:
             'resolution_height': '',
             'crop_coords': None,
             'copy_to_clipboard': False,
-            'font_size': 12
+            'font_size': 12,
+            'record_trace': False,
+            'template_match': True,
+            'trace_dir': 'traces'
         }
         
         if os.path.exists(self.config_file):
@@ -120,6 +126,18 @@ class WFOCRApp:
                        variable=self.clipboard_var,
                        command=self.on_clipboard_change).pack(side='left', padx=10)
         
+        # 录制识别轨迹选项
+        self.trace_var = tk.BooleanVar(value=self.config['record_trace'])
+        ttk.Checkbutton(control_frame, text="录制识别轨迹", 
+                       variable=self.trace_var,
+                       command=self.on_trace_change).pack(side='left', padx=10)
+        
+        # 模板匹配选项
+        self.template_var = tk.BooleanVar(value=self.config['template_match'])
+        ttk.Checkbutton(control_frame, text="模板匹配加速", 
+                       variable=self.template_var,
+                       command=self.on_template_change).pack(side='left', padx=10)
+        
         # 字号选择
         ttk.Label(control_frame, text="字号:").pack(side='left', padx=(20, 5))
         self.font_size_var = tk.StringVar(value=str(self.config['font_size']))
@@ -352,8 +370,13 @@ class WFOCRApp:
             img_array = np.array(cropped)
             img_array = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
             
-            # OCR识别
-            results = ocr_and_search_prices(img_array)
+            # OCR识别，开启录制时同时保存轨迹以便离线回放
+            template_bank = get_template_bank() if self.template_var.get() else None
+            if self.trace_var.get():
+                results = record_press(img_array, self.config['trace_dir'],
+                                       template_bank=template_bank)
+            else:
+                results = ocr_and_search_prices(img_array, template_bank=template_bank)
             
             # 显示结果
             self.display_results(results)
@@ -411,6 +434,16 @@ class WFOCRApp:
         self.config['copy_to_clipboard'] = self.clipboard_var.get()
         self.save_config()
     
+    def on_trace_change(self):
+        """录制识别轨迹选项改变"""
+        self.config['record_trace'] = self.trace_var.get()
+        self.save_config()
+    
+    def on_template_change(self):
+        """模板匹配选项改变"""
+        self.config['template_match'] = self.template_var.get()
+        self.save_config()
+    
     def on_font_size_change(self, event=None):
         """字号改变"""
         try:
@@ -439,9 +472,11 @@ class WFOCRApp:
         """预热OCR，在后台初始化以减少首次使用延迟"""
         def init_ocr():
             try:
-                # 触发OCR初始化
-                from ocr import get_ocr_reader
-                get_ocr_reader()
+                # 触发OCR初始化，启动全部识别进程
+                from ocr import get_slot_recognizer
+                get_slot_recognizer().warm_up()
+                if self.config['template_match']:
+                    get_template_bank()
                 print("OCR预热完成")
             except Exception as e:
                 print(f"OCR预热失败: {e}")
@@ -451,13 +486,19 @@ class WFOCRApp:
     
     def on_closing(self):
         """程序关闭"""
-        self.stop_script()
-        self.root.destroy()
+        try:
+            self.stop_script()
+            # 保存运行中收集到的模板
+            flush_template_bank()
+        finally:
+            self.root.destroy()
     
     def run(self):
         """运行程序"""
         self.root.mainloop()
 
 if __name__ == "__main__":
+    # 打包后的程序需要支持多进程识别
+    multiprocessing.freeze_support()
     app = WFOCRApp()
     app.run()